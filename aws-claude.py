@@ -17,14 +17,22 @@ limitations under the License.
 from flask import Flask, request, Response, jsonify
 import boto3
 import json
+import orjson
 import tiktoken
 import time
 import io
 import random
 import logging
 import os
-from botocore.exceptions import ClientError
-from logging.handlers import RotatingFileHandler
+import queue
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectionError as BotoConnectionError
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # 调试模式配置
 DEBUG_MODE = os.environ.get('DEBUG_MODE', 'false').lower() == 'true'
@@ -54,35 +62,63 @@ file_handler = RotatingFileHandler(
 file_handler.setLevel(logging.DEBUG if DEBUG_MODE else logging.INFO)
 file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
+# 通过队列异步写日志：请求线程只负责入队，由后台监听线程完成实际的控制台/文件写入
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 # 添加处理器到logger
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.addHandler(queue_handler)
 
 # 如果是调试模式，还可以配置更详细的boto3/botocore日志
 if DEBUG_MODE:
+    # AWS SDK日志只写入文件，同样经由独立队列异步写入
+    sdk_log_queue = queue.SimpleQueue()
+    sdk_queue_handler = QueueHandler(sdk_log_queue)
+    sdk_log_listener = QueueListener(sdk_log_queue, file_handler, respect_handler_level=True)
+    sdk_log_listener.start()
+    atexit.register(sdk_log_listener.stop)
+    
     # 设置AWS SDK的日志级别
     boto3_logger = logging.getLogger('boto3')
     boto3_logger.setLevel(logging.DEBUG)
-    boto3_logger.addHandler(file_handler)
+    boto3_logger.addHandler(sdk_queue_handler)
     
     botocore_logger = logging.getLogger('botocore')
     botocore_logger.setLevel(logging.DEBUG)
-    botocore_logger.addHandler(file_handler)
+    botocore_logger.addHandler(sdk_queue_handler)
     
     urllib3_logger = logging.getLogger('urllib3')
     urllib3_logger.setLevel(logging.INFO)
-    urllib3_logger.addHandler(file_handler)
+    urllib3_logger.addHandler(sdk_queue_handler)
     
     logger.debug("调试模式已启用 - 将输出详细日志信息")
 else:
     logger.info("运行在正常模式 - 仅输出信息和警告日志")
 
 app = Flask(__name__)
-bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1')
+
+# Bedrock客户端配置：扩大连接池并开启TCP keepalive以复用连接；
+# 重试（节流、服务端临时错误、连接错误）统一由invoke_with_retry负责，这里关闭boto3自带的重试，避免重复重试叠加延迟
+bedrock_config = Config(
+    region_name='us-east-1',
+    max_pool_connections=64,
+    retries={'total_max_attempts': 1, 'mode': 'standard'},  # 只发送一次，不做SDK层重试
+    tcp_keepalive=True,
+    connect_timeout=10,
+    read_timeout=600  # 长输出和流式响应可能持续数分钟
+)
+bedrock_runtime = boto3.client('bedrock-runtime', config=bedrock_config)
 
 # 全局配置
 DEFAULT_MAX_TOKENS = 4096  # 默认输出token限制
 MAX_OUTPUT_TOKENS = 128000  # Claude 3.7支持的最大输出tokens
+MIN_THINKING_BUDGET = 1024  # 思考模式要求的最低思考预算（同时也是思考模式下max_tokens的下限）
+DEFAULT_THINKING_BUDGET = 4000  # 默认/推荐的思考预算
+# 请求中可用于指定思考预算的参数名，按优先级排列
+THINKING_BUDGET_KEYS = ('max_thinking_tokens', 'thinking_max_tokens', 'max_thinking_length')
 
 # 模型映射字典
 MODEL_MAPPING = {
@@ -96,303 +132,494 @@ MODEL_MAPPING = {
     'claude-instant': 'anthropic.claude-instant-v1'
 }
 
+# 模型ID到模型名称的反向映射，多个名称共用同一ID时保留最先定义的名称（非思考模式）
+MODEL_ID_TO_NAME = {v: k for k, v in reversed(list(MODEL_MAPPING.items()))}
+
 # 默认模型 - Claude 3.7
 DEFAULT_MODEL_ID = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'
 
+# 只读的空映射，在流式循环中作为缺失字段的默认值复用，避免每个事件都新建空字典
+EMPTY_MAPPING = MappingProxyType({})
+
+# 可能携带内容增量或结束原因的Bedrock流式事件类型
+STREAM_DELTA_EVENT_TYPES = frozenset({'content_block_delta', 'message_delta'})
+
+# /v1/completions流式事件的固定部分，预先编码为bytes，
+# 拼接后等价于 data: {"choices":[{"text":...,"index":0,"finish_reason":...}]}
+COMPLETION_SSE_PREFIX = b'data: {"choices":[{"text":'
+COMPLETION_SSE_MIDDLE = b',"index":0,"finish_reason":'
+COMPLETION_SSE_SUFFIX = b'}]}\n\n'
+
+# /v1/chat/completions流式事件的固定部分，每个chunk由
+# build_chat_sse_prefix()的结果 + delta + finish_reason + 结尾拼接而成
+CHAT_SSE_CONTENT_DELTA = b'{"content":'
+CHAT_SSE_THINKING_DELTA = b'{"thinking":'
+CHAT_SSE_FINISH_REASON = b'},"finish_reason":'
+CHAT_SSE_EMPTY_DELTA = b'{},"finish_reason":'
+CHAT_SSE_SUFFIX = b'}]}\n\n'
+SSE_DONE = b"data: [DONE]\n\n"
+
 # 重试配置
 MAX_RETRIES = 5  # 最大重试次数
 BASE_DELAY = 1  # 基础延迟时间（秒）
 MAX_DELAY = 30  # 最大延迟时间（秒）
+# 可重试的AWS错误码（节流和服务端临时错误），HTTP 5xx响应同样会重试
+RETRYABLE_ERROR_CODES = frozenset({
+    'ThrottlingException',
+    'ServiceUnavailableException',
+    'InternalServerException',
+    'ModelNotReadyException'
+})
 
-def log_request_info(endpoint, request_data):
-    """记录请求信息，在调试模式下输出详细信息"""
-    if DEBUG_MODE:
-        # 创建一个可以安全打印的请求数据副本
-        safe_data = request_data.copy() if request_data else {}
-        
-        # 如果有prompt或messages，可能会很长，截断它们
-        if 'prompt' in safe_data and isinstance(safe_data['prompt'], str) and len(safe_data['prompt']) > 200:
-            safe_data['prompt'] = safe_data['prompt'][:200] + '... [截断，完整内容仅在trace级别日志中]'
-            
-        if 'messages' in safe_data and isinstance(safe_data['messages'], list):
-            for i, msg in enumerate(safe_data['messages']):
-                if isinstance(msg, dict) and 'content' in msg and isinstance(msg['content'], str) and len(msg['content']) > 200:
-                    safe_data['messages'][i]['content'] = msg['content'][:200] + '... [截断]'
-        
-        logger.debug(f"API请求 {endpoint}: {json.dumps(safe_data, ensure_ascii=False, indent=2)}")
+# Token计数编码器 - 构建开销较大，启动时加载一次并在所有请求间复用
+TOKEN_ENCODER = tiktoken.get_encoding("cl100k_base")
+
+# 按消息缓存的token计数（LRU），键为文本摘要
+TOKEN_COUNT_CACHE_SIZE = 4096
+token_count_cache = OrderedDict()
+token_count_cache_lock = threading.Lock()
+
+def _log_request_info_debug(endpoint, request_data):
+    """记录请求信息（调试模式，输出详细信息）"""
+    # 创建一个可以安全打印的请求数据副本
+    safe_data = request_data.copy() if request_data else {}
+    
+    # 如果有prompt或messages，可能会很长，截断它们
+    if 'prompt' in safe_data and isinstance(safe_data['prompt'], str) and len(safe_data['prompt']) > 200:
+        safe_data['prompt'] = safe_data['prompt'][:200] + '... [截断，完整内容仅在trace级别日志中]'
         
-        # 如果需要完整日志，可以设置更详细的级别
-        logger.log(5, f"完整API请求 {endpoint}: {json.dumps(request_data, ensure_ascii=False, indent=2)}")
-    else:
-        # 非调试模式只记录请求类型
-        logger.info(f"处理API请求: {endpoint}")
+    if 'messages' in safe_data and isinstance(safe_data['messages'], list):
+        # 构建新的消息列表，避免截断时修改调用方的原始消息
+        safe_data['messages'] = [
+            {**msg, 'content': msg['content'][:200] + '... [截断]'}
+            if isinstance(msg, dict) and isinstance(msg.get('content'), str) and len(msg['content']) > 200
+            else msg
+            for msg in safe_data['messages']
+        ]
+    
+    logger.debug("API请求 %s: %s", endpoint, orjson.dumps(safe_data, option=orjson.OPT_INDENT_2).decode())
+    
+    # 如果需要完整日志，可以设置更详细的级别
+    if logger.isEnabledFor(5):
+        logger.log(5, "完整API请求 %s: %s", endpoint, orjson.dumps(request_data, option=orjson.OPT_INDENT_2).decode())
 
-def log_response_info(endpoint, response_data, is_error=False):
-    """记录响应信息，在调试模式下输出详细信息"""
-    if DEBUG_MODE:
-        if is_error:
-            logger.error(f"API错误响应 {endpoint}: {json.dumps(response_data, ensure_ascii=False)}")
-        else:
-            # 创建一个可以安全打印的响应数据副本
-            safe_data = response_data.copy() if isinstance(response_data, dict) else {'data': str(response_data)[:200]}
-            
-            # 如果有choices，截断内容
-            if 'choices' in safe_data and isinstance(safe_data['choices'], list):
-                for i, choice in enumerate(safe_data['choices']):
-                    if isinstance(choice, dict):
-                        # 处理文本完成
-                        if 'text' in choice and isinstance(choice['text'], str) and len(choice['text']) > 200:
-                            safe_data['choices'][i]['text'] = choice['text'][:200] + '... [截断]'
-                        
-                        # 处理聊天完成
-                        if 'message' in choice and isinstance(choice['message'], dict) and 'content' in choice['message']:
-                            if isinstance(choice['message']['content'], str) and len(choice['message']['content']) > 200:
-                                safe_data['choices'][i]['message']['content'] = choice['message']['content'][:200] + '... [截断]'
-                        
-                        # 处理思考内容
-                        if 'thinking' in choice and isinstance(choice['thinking'], str) and len(choice['thinking']) > 200:
-                            safe_data['choices'][i]['thinking'] = choice['thinking'][:200] + '... [截断]'
-            
-            logger.debug(f"API响应 {endpoint}: {json.dumps(safe_data, ensure_ascii=False)}")
+def _log_request_info_prod(endpoint, request_data):
+    """记录请求信息（正常模式，只记录请求类型）"""
+    logger.info("处理API请求: %s", endpoint)
+
+def _log_response_info_debug(endpoint, response_data, is_error=False):
+    """记录响应信息（调试模式，输出详细信息）"""
+    if is_error:
+        logger.error("API错误响应 %s: %s", endpoint, json.dumps(response_data, ensure_ascii=False))
+        return
+    
+    # 创建一个可以安全打印的响应数据副本
+    safe_data = response_data.copy() if isinstance(response_data, dict) else {'data': str(response_data)[:200]}
+    
+    # 如果有choices，截断内容（构建新的choice对象，避免修改即将返回给客户端的响应）
+    if 'choices' in safe_data and isinstance(safe_data['choices'], list):
+        safe_choices = []
+        for choice in safe_data['choices']:
+            if isinstance(choice, dict):
+                choice = dict(choice)
+                # 处理文本完成
+                if isinstance(choice.get('text'), str) and len(choice['text']) > 200:
+                    choice['text'] = choice['text'][:200] + '... [截断]'
+                
+                # 处理聊天完成
+                message = choice.get('message')
+                if isinstance(message, dict) and isinstance(message.get('content'), str) and len(message['content']) > 200:
+                    choice['message'] = {**message, 'content': message['content'][:200] + '... [截断]'}
+                
+                # 处理思考内容
+                if isinstance(choice.get('thinking'), str) and len(choice['thinking']) > 200:
+                    choice['thinking'] = choice['thinking'][:200] + '... [截断]'
+            safe_choices.append(choice)
+        safe_data['choices'] = safe_choices
+    
+    logger.debug("API响应 %s: %s", endpoint, json.dumps(safe_data, ensure_ascii=False))
+
+def _log_response_info_prod(endpoint, response_data, is_error=False):
+    """记录响应信息（正常模式，只记录响应状态）"""
+    if is_error:
+        logger.error("API错误响应: %s", endpoint)
     else:
-        # 非调试模式只记录响应状态
-        if is_error:
-            logger.error(f"API错误响应: {endpoint}")
-        else:
-            logger.info(f"API请求完成: {endpoint}")
+        logger.info("API请求完成: %s", endpoint)
+
+# 调试模式在进程启动时即已确定，启动时选定日志函数，避免每个请求都重复判断
+if DEBUG_MODE:
+    log_request_info = _log_request_info_debug
+    log_response_info = _log_response_info_debug
+else:
+    log_request_info = _log_request_info_prod
+    log_response_info = _log_response_info_prod
+
+def json_response(data):
+    """使用orjson直接序列化为bytes并返回JSON响应，省去jsonify的序列化开销"""
+    return Response(orjson.dumps(data), mimetype='application/json')
 
 def count_tokens(text):
-    encoder = tiktoken.get_encoding("cl100k_base")
-    return len(encoder.encode(text))
+    return len(TOKEN_ENCODER.encode(text))
+
+def count_tokens_cached(text):
+    """带缓存的token计数，用于跨请求重复出现的文本（如系统提示、历史消息）"""
+    # 以文本摘要为键，缓存中只保存摘要和计数，不长期持有消息原文
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with token_count_cache_lock:
+        count = token_count_cache.get(key)
+        if count is not None:
+            token_count_cache.move_to_end(key)
+            return count
+    
+    count = count_tokens(text)
+    with token_count_cache_lock:
+        token_count_cache[key] = count
+        if len(token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            token_count_cache.popitem(last=False)
+    return count
+
+def get_message_text(content):
+    """提取消息内容中的文本，兼容字符串和多模态列表两种格式"""
+    if isinstance(content, list):
+        return ''.join(item.get('text', '') for item in content if isinstance(item, dict) and item.get('type') == 'text')
+    return content or ''
 
 def stream_iter_lines(stream):
-    buffer = b''
+    # 使用可变的bytearray原地消费已读取的行，避免每次拼接/切片都复制整个缓冲区
+    buffer = bytearray()
     for chunk in stream:
-        buffer += chunk
+        buffer.extend(chunk)
+        start = 0
         while True:
-            newline_pos = buffer.find(b'\n')
+            newline_pos = buffer.find(b'\n', start)
             if newline_pos == -1:
                 break
-            line, buffer = buffer[:newline_pos], buffer[newline_pos+1:]
-            yield line
+            yield bytes(buffer[start:newline_pos])
+            start = newline_pos + 1
+        if start:
+            del buffer[:start]
     if buffer:
-        yield buffer
+        yield bytes(buffer)
 
-def validate_bedrock_request(params):
-    """验证发送到Bedrock API的请求参数"""
-    if DEBUG_MODE:
-        logger.debug("正在验证Bedrock请求参数...")
-        
-    # 深度复制参数防止修改原始对象
-    validated_params = params.copy() if params else {}
+def extract_bedrock_content(bed_response):
+    """单次遍历Bedrock响应的content块，返回(文本内容, 思考内容)"""
+    content_obj = bed_response.get('content')
+    thinking_parts = []
     
-    # 检查是否使用思考模式
-    is_thinking_enabled = False
+    if isinstance(content_obj, list):
+        text_parts = []
+        for item in content_obj:
+            item_type = item.get('type')
+            if item_type == 'text':
+                text_parts.append(item.get('text', ''))
+            elif item_type == 'thinking':
+                thinking_parts.append(item.get('thinking', ''))
+        content = ''.join(text_parts)
+    else:
+        # 旧格式响应处理
+        content = bed_response.get('completion', '')
+        if not content:
+            content = str(content_obj) if content_obj else ''
     
-    # 从参数中检查模型名称
-    model_is_thinking = False
+    # 优先使用顶级thinking字段，否则使用content中thinking类型的块（按原文直接拼接）
+    thinking_obj = bed_response.get('thinking')
+    thinking_content = thinking_obj.get('text', '') if isinstance(thinking_obj, dict) else ''
+    if not thinking_content:
+        thinking_content = ''.join(thinking_parts)
     
-    # 直接从_model_name参数检查（由invoke_with_retry添加）
-    if '_model_name' in validated_params and validated_params['_model_name'] == 'claude-3-7-sonnet-thinking':
-        model_is_thinking = True
+    return content, thinking_content
+
+def get_bedrock_token_usage(response, bed_response):
+    """获取Bedrock返回的token用量(输入, 输出)，优先使用响应体中的usage，其次是响应头，都缺失时返回None"""
+    usage = bed_response.get('usage')
+    if isinstance(usage, dict):
+        input_tokens = usage.get('input_tokens')
+        output_tokens = usage.get('output_tokens')
+        if isinstance(input_tokens, int) and isinstance(output_tokens, int):
+            return input_tokens, output_tokens
+    return get_header_token_usage(response)
+
+def get_header_token_usage(response):
+    """从Bedrock响应头中读取token用量，缺失或无效时返回None"""
+    headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    input_tokens = headers.get('x-amzn-bedrock-input-token-count')
+    output_tokens = headers.get('x-amzn-bedrock-output-token-count')
+    if input_tokens is None or output_tokens is None:
+        return None
+    try:
+        return int(input_tokens), int(output_tokens)
+    except (ValueError, TypeError):
+        return None
+
+def build_chat_sse_prefix(stream_id, created, model_name):
+    """预先编码聊天流式事件中每个chunk都相同的开头部分（id、object、created、model）"""
+    return (b'data: {"id":' + orjson.dumps(stream_id)
+            + b',"object":"chat.completion.chunk","created":' + orjson.dumps(created)
+            + b',"model":' + orjson.dumps(model_name)
+            + b',"choices":[{"index":0,"delta":')
+
+def _chat_sse_content_block_delta(chunk, prefix):
+    """处理content_block_delta事件：输出思考内容或普通文本增量"""
+    delta = chunk.get('delta') or EMPTY_MAPPING
+    delta_type = delta.get('type')
+    
+    # 检查是否是思考块
+    if delta_type == 'thinking_delta':
+        thinking_text = delta.get('thinking', '')
+        if thinking_text:
+            return (prefix + CHAT_SSE_THINKING_DELTA + orjson.dumps(thinking_text)
+                    + CHAT_SSE_FINISH_REASON + b'null' + CHAT_SSE_SUFFIX)
+    
+    # 检查是否是文本块
+    elif delta_type == 'text_delta':
+        text = delta.get('text', '')
+        if text:
+            return (prefix + CHAT_SSE_CONTENT_DELTA + orjson.dumps(text)
+                    + CHAT_SSE_FINISH_REASON + b'null' + CHAT_SSE_SUFFIX)
+    return None
+
+def _chat_sse_message_delta(chunk, prefix):
+    """处理message_delta事件：输出结束原因和结束标记"""
+    stop_reason = (chunk.get('delta') or EMPTY_MAPPING).get('stop_reason')
+    if not stop_reason:
+        return None
+    finish_reason = 'stop' if stop_reason == 'end_turn' else stop_reason
+    return prefix + CHAT_SSE_EMPTY_DELTA + orjson.dumps(finish_reason) + CHAT_SSE_SUFFIX + SSE_DONE
+
+def _chat_sse_legacy(chunk, prefix):
+    """兼容旧版流式响应格式（没有type字段）"""
+    text = (chunk.get('delta') or EMPTY_MAPPING).get('text', "")
+    stop_reason = chunk.get('stop_reason', None)
+    
+    data = b''
+    if text:
+        data = (prefix + CHAT_SSE_CONTENT_DELTA + orjson.dumps(text)
+                + CHAT_SSE_FINISH_REASON + orjson.dumps(stop_reason or None) + CHAT_SSE_SUFFIX)
+    if stop_reason:
+        data += SSE_DONE
+    return data
+
+# 聊天流式事件类型到处理函数的映射，未列出的事件类型（如message_start、ping）不输出内容
+CHAT_SSE_HANDLERS = {
+    'content_block_delta': _chat_sse_content_block_delta,
+    'message_delta': _chat_sse_message_delta,
+    '': _chat_sse_legacy
+}
+
+def to_int(value, default, name):
+    """将参数值转换为整数，无效时记录警告并返回默认值"""
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        logger.warning("%s值无效: %s，将设置为默认值%s", name, value, default)
+        return default
+
+def validate_bedrock_request(params):
+    """验证发送到Bedrock API的请求参数（直接修改并返回传入的参数字典）"""
+    logger.debug("正在验证Bedrock请求参数...")
+    
+    if params is None:
+        params = {}
+    
+    # 检查是否使用思考模式模型：_model_name由invoke_with_retry添加，model来自API请求
+    model_is_thinking = (
+        params.get('_model_name') == 'claude-3-7-sonnet-thinking'
+        or (isinstance(params.get('messages'), list) and params.get('model') == 'claude-3-7-sonnet-thinking')
+    )
+    if model_is_thinking:
         logger.debug("检测到使用思考模式模型: claude-3-7-sonnet-thinking")
-    # 从API请求中检查
-    elif 'messages' in validated_params and isinstance(validated_params.get('messages'), list):
-        # 这可能是API请求，提取model_name
-        if 'model' in validated_params and validated_params['model'] == 'claude-3-7-sonnet-thinking':
-            model_is_thinking = True
-            logger.debug("检测到使用思考模式模型: claude-3-7-sonnet-thinking")
+    
+    # 一次性取出需要检查的字段，所有检查都基于局部变量，最后统一写回
+    is_thinking_enabled = 'thinking' in params
+    thinking = params.get('thinking')
+    has_max_tokens = 'max_tokens' in params
+    max_tokens = params.get('max_tokens', DEFAULT_MAX_TOKENS)
     
     # 检查思考模式参数
-    if 'thinking' in validated_params:
-        is_thinking_enabled = True
-        thinking = validated_params['thinking']
-        
+    if is_thinking_enabled:
         # 检查thinking格式是否正确
         if not isinstance(thinking, dict):
             logger.warning(f"思考参数类型错误: {type(thinking).__name__}，将重置为标准格式")
-            thinking = {"type": "enabled", "budget_tokens": 4000}
-            validated_params['thinking'] = thinking
+            thinking = {"type": "enabled", "budget_tokens": DEFAULT_THINKING_BUDGET}
         
         # 确保有type和budget_tokens字段
-        if 'type' not in thinking or thinking.get('type') != 'enabled':
+        if thinking.get('type') != 'enabled':
             logger.warning("思考参数缺少正确的type字段，将设置为'enabled'")
             thinking['type'] = 'enabled'
         
         # 验证budget_tokens
         if 'budget_tokens' not in thinking:
-            logger.warning("思考参数缺少budget_tokens字段，将设置为默认值4000")
-            thinking['budget_tokens'] = 4000
+            logger.warning(f"思考参数缺少budget_tokens字段，将设置为默认值{DEFAULT_THINKING_BUDGET}")
+            thinking['budget_tokens'] = DEFAULT_THINKING_BUDGET
         else:
-            try:
-                # 确保budget_tokens是整数
-                budget = int(thinking['budget_tokens'])
-                if budget < 1024:
-                    logger.warning(f"思考预算 {budget} 小于最低要求的1024，将调整为1024")
-                    budget = 1024
-                thinking['budget_tokens'] = budget
-            except (ValueError, TypeError):
-                logger.warning(f"思考预算值无效: {thinking.get('budget_tokens')}，将设置为默认值4000")
-                thinking['budget_tokens'] = 4000
+            # 确保budget_tokens是整数
+            budget = to_int(thinking['budget_tokens'], DEFAULT_THINKING_BUDGET, '思考预算')
+            if budget < MIN_THINKING_BUDGET:
+                logger.warning(f"思考预算 {budget} 小于最低要求的{MIN_THINKING_BUDGET}，将调整为{MIN_THINKING_BUDGET}")
+                budget = MIN_THINKING_BUDGET
+            thinking['budget_tokens'] = budget
     
     # 如果启用了思考模式或使用思考模式模型，确保max_tokens足够大
-    if (is_thinking_enabled or model_is_thinking) and 'max_tokens' in validated_params:
-        try:
-            max_tokens = int(validated_params['max_tokens'])
-            if max_tokens < 1024:
-                logger.warning(f"思考模式下max_tokens必须至少为1024，已从{max_tokens}调整为1024")
-                validated_params['max_tokens'] = 1024
-        except (ValueError, TypeError):
-            logger.warning(f"max_tokens值无效: {validated_params.get('max_tokens')}，将设置为默认值4096")
-            validated_params['max_tokens'] = 4096
+    if (is_thinking_enabled or model_is_thinking) and has_max_tokens:
+        max_tokens = to_int(max_tokens, DEFAULT_MAX_TOKENS, 'max_tokens')
+        if max_tokens < MIN_THINKING_BUDGET:
+            logger.warning(f"思考模式下max_tokens必须至少为{MIN_THINKING_BUDGET}，已从{max_tokens}调整为{MIN_THINKING_BUDGET}")
+            max_tokens = MIN_THINKING_BUDGET
     
-    if model_is_thinking and 'thinking' not in validated_params:
-        # 只有在用户没有明确禁用thinking的情况下添加
-        if validated_params.get('thinking') is not False:
-            logger.info("检测到思考模式模型但未指定thinking参数，自动添加")
-            
-            # 确保max_tokens足够大
-            max_tokens = validated_params.get('max_tokens', DEFAULT_MAX_TOKENS)
-            # 转为整数
-            try:
-                max_tokens = int(max_tokens)
-            except (ValueError, TypeError):
-                max_tokens = DEFAULT_MAX_TOKENS
-                
-            # 思考模式需要max_tokens至少为1024
-            if max_tokens < 1024:
-                logger.warning(f"思考模式模型要求max_tokens至少为1024，已将值从{max_tokens}调整为1024")
-                max_tokens = 1024
-                validated_params['max_tokens'] = max_tokens
-            
-            # 添加思考参数，预算设为max_tokens的80%但不小于1024
-            thinking_budget = max(1024, min(int(max_tokens * 0.8), max_tokens - 1))
-            validated_params['thinking'] = {
-                "type": "enabled",
-                "budget_tokens": thinking_budget
-            }
+    if model_is_thinking and not is_thinking_enabled:
+        logger.info("检测到思考模式模型但未指定thinking参数，自动添加")
+        
+        # 添加思考参数，预算设为max_tokens的80%但不小于最低预算（max_tokens此时已保证不小于最低预算）
+        thinking_budget = max(MIN_THINKING_BUDGET, min(int(max_tokens * 0.8), max_tokens - 1))
+        thinking = {
+            "type": "enabled",
+            "budget_tokens": thinking_budget
+        }
     
-    # 如果启用了思考模式，再次检查max_tokens是否足够
-    if validated_params.get('thinking') and isinstance(validated_params['thinking'], dict):
-        # 获取thinking预算
-        thinking_budget = validated_params['thinking'].get('budget_tokens', 0)
-        try:
-            thinking_budget = int(thinking_budget)
-        except (ValueError, TypeError):
-            thinking_budget = 4000
-            validated_params['thinking']['budget_tokens'] = thinking_budget
-            
-        # 获取max_tokens
-        max_tokens = validated_params.get('max_tokens', DEFAULT_MAX_TOKENS)
-        try:
-            max_tokens = int(max_tokens)
-        except (ValueError, TypeError):
-            max_tokens = DEFAULT_MAX_TOKENS
-            
-        # 确保max_tokens大于thinking预算
+    # 如果启用了思考模式，确保max_tokens大于thinking预算
+    if thinking and isinstance(thinking, dict):
+        thinking_budget = thinking['budget_tokens']
         if max_tokens <= thinking_budget:
             logger.warning(f"max_tokens({max_tokens})必须大于thinking预算({thinking_budget})，调整max_tokens为{thinking_budget + 1}")
-            validated_params['max_tokens'] = thinking_budget + 1
+            max_tokens = thinking_budget + 1
+            has_max_tokens = True
         
         # 当启用思考模式时，必须移除top_p参数（AWS API限制）
-        if 'top_p' in validated_params:
+        if 'top_p' in params:
             logger.warning("思考模式下不能设置top_p参数，已自动移除")
-            del validated_params['top_p']
+            del params['top_p']
+        
+        params['thinking'] = thinking
     
-    if DEBUG_MODE:
-        logger.debug("请求参数验证完成")
+    if has_max_tokens:
+        params['max_tokens'] = max_tokens
+    
+    logger.debug("请求参数验证完成")
+    
+    return params
+
+def _log_bedrock_request_debug(func, kwargs, params):
+    """记录即将发送的Bedrock API调用详情（调试模式）"""
+    func_name = func.__name__ if hasattr(func, '__name__') else str(func)
+    model_id = kwargs.get('modelId', 'unknown_model')
+    logger.debug("准备调用 AWS Bedrock API: %s, 模型: %s", func_name, model_id)
+    
+    # 如果有请求体，记录格式化后的请求体，但需要确保敏感信息不会被完全记录
+    if params is not None:
+        # 创建一个可以安全打印的请求体副本，截断很长的文本（不修改原始消息）
+        safe_body = params.copy()
+        if 'messages' in safe_body and isinstance(safe_body['messages'], list):
+            safe_body['messages'] = [
+                dict(msg, content=msg['content'][:200] + "... [截断]")
+                if isinstance(msg, dict) and isinstance(msg.get('content'), str) and len(msg['content']) > 200
+                else msg
+                for msg in safe_body['messages']
+            ]
         
-    return validated_params
+        logger.debug("请求参数: %s", orjson.dumps(safe_body, option=orjson.OPT_INDENT_2).decode())
+
+def _log_bedrock_request_prod(func, kwargs, params):
+    """正常模式下不记录Bedrock调用详情"""
+
+def _call_bedrock_debug(func, kwargs):
+    """调用Bedrock API并记录耗时和响应头信息（调试模式）"""
+    start_time = time.time()
+    response = func(**kwargs)
+    elapsed_time = time.time() - start_time
+    logger.debug("API调用成功，耗时: %.2f秒", elapsed_time)
+    
+    # 记录响应头信息，通常包含有用的调试信息如token计数
+    if hasattr(response, 'get') and callable(response.get) and response.get('ResponseMetadata'):
+        headers = response['ResponseMetadata'].get('HTTPHeaders', {})
+        if headers:
+            logger.debug("响应头信息: %s", json.dumps(headers, ensure_ascii=False))
+            
+            # 特别记录token计数信息
+            token_info = {
+                'input_tokens': headers.get('x-amzn-bedrock-input-token-count'),
+                'output_tokens': headers.get('x-amzn-bedrock-output-token-count')
+            }
+            if any(token_info.values()):
+                logger.debug("Token用量: %s", json.dumps(token_info))
+    
+    return response
+
+def _call_bedrock_prod(func, kwargs):
+    """调用Bedrock API（正常模式）"""
+    return func(**kwargs)
+
+# 同样在启动时选定Bedrock调用的日志方式
+if DEBUG_MODE:
+    log_bedrock_request = _log_bedrock_request_debug
+    call_bedrock = _call_bedrock_debug
+else:
+    log_bedrock_request = _log_bedrock_request_prod
+    call_bedrock = _call_bedrock_prod
 
-def invoke_with_retry(func, **kwargs):
-    """使用指数退避重试机制调用 AWS Bedrock API"""
+def invoke_with_retry(func, body_dict=None, **kwargs):
+    """使用指数退避重试机制调用 AWS Bedrock API，body_dict经验证后只序列化一次作为请求体"""
     retries = 0
+    params = None
     
-    # 调试日志：记录API调用详情
-    if DEBUG_MODE:
-        func_name = func.__name__ if hasattr(func, '__name__') else str(func)
-        model_id = kwargs.get('modelId', 'unknown_model')
-        logger.debug(f"准备调用 AWS Bedrock API: {func_name}, 模型: {model_id}")
+    if body_dict is not None:
+        model_id = kwargs.get('modelId', '')
+        params = dict(body_dict)
         
-        # 如果有请求体，记录格式化后的请求体，但需要确保敏感信息不会被完全记录
-        if 'body' in kwargs and kwargs['body']:
-            try:
-                body_dict = json.loads(kwargs['body'])
-                
-                # 添加模型ID信息到请求参数中
-                model_id = kwargs.get('modelId', '')
-                # 从MODEL_MAPPING反向查找模型名称
-                model_name = next((k for k, v in MODEL_MAPPING.items() if v == model_id), '')
-                if model_name:
-                    body_dict['_model_name'] = model_name
-                
-                # 验证请求参数
-                body_dict = validate_bedrock_request(body_dict)
-                
-                # 从参数中移除临时添加的模型名称
-                if '_model_name' in body_dict:
-                    del body_dict['_model_name']
-                
-                # 更新请求体
-                kwargs['body'] = json.dumps(body_dict)
-                
-                # 创建一个可以安全打印的请求体副本
-                safe_body = body_dict.copy()
-                
-                # 如果有很长的文本，进行截断
-                if 'messages' in safe_body and isinstance(safe_body['messages'], list):
-                    for i, msg in enumerate(safe_body['messages']):
-                        if 'content' in msg and isinstance(msg['content'], str) and len(msg['content']) > 200:
-                            safe_body['messages'][i]['content'] = msg['content'][:200] + "... [截断]"
-                
-                logger.debug(f"请求参数: {json.dumps(safe_body, ensure_ascii=False, indent=2)}")
-            except Exception as e:
-                logger.debug(f"无法解析请求体进行日志记录: {str(e)}")
+        # 添加模型ID信息到请求参数中，反向查找模型名称
+        model_name = MODEL_ID_TO_NAME.get(model_id, '')
+        if model_name:
+            params['_model_name'] = model_name
+        
+        # 验证请求参数
+        params = validate_bedrock_request(params)
+        
+        # 从参数中移除临时添加的模型名称
+        params.pop('_model_name', None)
+        
+        # 使用orjson紧凑格式序列化，只序列化一次，直接以bytes作为请求体
+        kwargs['body'] = orjson.dumps(params)
+    
+    # 调试日志：记录API调用详情
+    log_bedrock_request(func, kwargs, params)
     
     while retries <= MAX_RETRIES:
         try:
-            if DEBUG_MODE:
-                start_time = time.time()
-                
-            response = func(**kwargs)
-            
-            if DEBUG_MODE:
-                elapsed_time = time.time() - start_time
-                logger.debug(f"API调用成功，耗时: {elapsed_time:.2f}秒")
-                
-                # 记录响应头信息，通常包含有用的调试信息如token计数
-                if hasattr(response, 'get') and callable(response.get) and response.get('ResponseMetadata'):
-                    headers = response['ResponseMetadata'].get('HTTPHeaders', {})
-                    if headers:
-                        logger.debug(f"响应头信息: {json.dumps(headers, ensure_ascii=False)}")
-                        
-                        # 特别记录token计数信息
-                        token_info = {
-                            'input_tokens': headers.get('x-amzn-bedrock-input-token-count'),
-                            'output_tokens': headers.get('x-amzn-bedrock-output-token-count')
-                        }
-                        if any(token_info.values()):
-                            logger.debug(f"Token用量: {json.dumps(token_info)}")
-            
-            return response
+            return call_bedrock(func, kwargs)
             
         except ClientError as e:
             error_code = e.response.get('Error', {}).get('Code', '')
             error_msg = e.response.get('Error', {}).get('Message', '')
             
             if DEBUG_MODE:
-                logger.debug(f"AWS API 错误: {error_code} - {error_msg}")
-                logger.debug(f"完整错误响应: {json.dumps(e.response, ensure_ascii=False)}")
+                logger.debug("AWS API 错误: %s - %s", error_code, error_msg)
+                logger.debug("完整错误响应: %s", json.dumps(e.response, ensure_ascii=False, default=str))
             
-            if error_code == 'ThrottlingException' and retries < MAX_RETRIES:
+            status_code = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            is_retryable = error_code in RETRYABLE_ERROR_CODES or status_code >= 500
+            
+            if is_retryable and retries < MAX_RETRIES:
                 # 计算等待时间（指数退避 + 随机抖动）
                 delay = min(MAX_DELAY, BASE_DELAY * (2 ** retries) + random.uniform(0, 1))
-                logger.warning(f"遇到节流限制 ({error_msg})，等待 {delay:.2f} 秒后进行第 {retries+1} 次重试...")
+                if error_code == 'ThrottlingException':
+                    logger.warning(f"遇到节流限制 ({error_msg})，等待 {delay:.2f} 秒后进行第 {retries+1} 次重试...")
+                else:
+                    logger.warning(f"遇到临时错误 ({error_code}: {error_msg})，等待 {delay:.2f} 秒后进行第 {retries+1} 次重试...")
                 time.sleep(delay)
                 retries += 1
             else:
                 logger.error(f"AWS API 错误: {error_code} - {error_msg}")
                 raise
+        except (BotoConnectionError, ConnectionClosedError) as e:
+            # 请求被接收前的连接错误（连接超时、端点不可达、连接池中已被关闭的keepalive连接）按指数退避重试；
+            # 读取超时不重试，此时模型可能已在生成，重发会重复计费
+            if retries < MAX_RETRIES:
+                delay = min(MAX_DELAY, BASE_DELAY * (2 ** retries) + random.uniform(0, 1))
+                logger.warning(f"连接 AWS API 失败 ({str(e)})，等待 {delay:.2f} 秒后进行第 {retries+1} 次重试...")
+                time.sleep(delay)
+                retries += 1
+            else:
+                logger.error(f"连接 AWS API 失败: {str(e)}")
+                raise
         except Exception as e:
             if DEBUG_MODE:
                 logger.exception(f"调用 AWS API 时发生未知错误")
@@ -418,7 +645,7 @@ def completions():
             return jsonify(error_response), 400
             
         # 获取tokens配置
-        max_tokens = req.get('max_tokens', DEFAULT_MAX_TOKENS)
+        max_tokens = to_int(req.get('max_tokens', DEFAULT_MAX_TOKENS), DEFAULT_MAX_TOKENS, 'max_tokens')
         
         # 根据请求参数获取模型ID
         model_name = req.get('model', 'claude-3-7-sonnet')
@@ -470,19 +697,15 @@ def completions():
             # 添加思考参数
             if use_thinking_mode:
                 # 必须添加thinking参数，使用正确的对象格式
-                thinking_budget = None
-                if req.get('max_thinking_tokens', None):
-                    thinking_budget = req.get('max_thinking_tokens')
-                elif req.get('thinking_max_tokens', None):
-                    thinking_budget = req.get('thinking_max_tokens')
-                elif req.get('max_thinking_length', None):
-                    thinking_budget = req.get('max_thinking_length')
-                else:
-                    # 如果未指定，默认使用max_tokens的一半作为思考预算，但不小于4000（推荐值）
-                    thinking_budget = max(4000, int(max_tokens / 2))
+                # 按优先级取第一个指定了的思考预算参数（每个参数只查找一次），
+                # 如果都未指定，默认使用max_tokens的一半作为思考预算，但不小于4000（推荐值）
+                thinking_budget = next(
+                    (value for value in map(req.get, THINKING_BUDGET_KEYS) if value),
+                    max(DEFAULT_THINKING_BUDGET, max_tokens // 2)
+                )
                 
                 # 确保思考预算不小于最低要求的1024 tokens
-                thinking_budget = max(1024, thinking_budget)
+                thinking_budget = max(MIN_THINKING_BUDGET, to_int(thinking_budget, DEFAULT_THINKING_BUDGET, '思考预算'))
                 
                 # 确保思考预算小于max_tokens（AWS要求）
                 if thinking_budget >= max_tokens:
@@ -494,7 +717,7 @@ def completions():
                     "type": "enabled",
                     "budget_tokens": thinking_budget
                 }
-                logger.info(f"已启用Claude 3.7的思考模式，思考预算: {thinking_budget} tokens")
+                logger.info("已启用Claude 3.7的思考模式，思考预算: %s tokens", thinking_budget)
             
             # 支持超长输出模式（beta功能）
             if enable_extended_output and max_tokens > 64000:
@@ -512,37 +735,32 @@ def completions():
             bed_params['stop_sequences'] = stop
 
         if req.get('stream', False):
-            body = json.dumps(bed_params)
             try:
-                # 记录请求参数，便于调试
-                if 'claude-3-7' in model_name and req.get('thinking', False):
-                    logger.info(f"Claude 3.7思考模式请求参数: {json.dumps(bed_params, indent=2)}")
+                # 调试模式下记录请求参数，避免在正常模式下格式化较大的参数字典
+                if DEBUG_MODE and 'claude-3-7' in model_name and req.get('thinking', False):
+                    logger.info("Claude 3.7思考模式请求参数: %s", orjson.dumps(bed_params, option=orjson.OPT_INDENT_2).decode())
                 
                 # 使用重试机制调用流式API
                 response = invoke_with_retry(
                     bedrock_runtime.invoke_model_with_response_stream,
                     modelId=model_id, 
-                    body=body
+                    body_dict=bed_params
                 )
                 def generate_stream():
-                    last_completion = ""
                     for event in response['body']:
-                        chunk = json.loads(event['chunk']['bytes'].decode('utf-8'))
-                        delta = chunk.get('delta', {})
+                        chunk = orjson.loads(event['chunk']['bytes'])
+                        # 跳过不携带内容增量的事件（如message_start、ping），旧版格式没有type字段
+                        event_type = chunk.get('type')
+                        if event_type and event_type not in STREAM_DELTA_EVENT_TYPES:
+                            continue
+                        delta = chunk.get('delta') or EMPTY_MAPPING
                         completion = delta.get('text', "")
                         stop_reason = chunk.get('stop_reason', None)
                         if completion:
-                            finish_reason = stop_reason if stop_reason else None
-                            event = {
-                                "choices": [
-                                    {
-                                        "text": completion,
-                                        "index": 0,
-                                        "finish_reason": finish_reason
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(event)}\n\n"
+                            # 事件结构固定，只需序列化文本和结束原因两个可变字段
+                            yield (COMPLETION_SSE_PREFIX + orjson.dumps(completion)
+                                   + COMPLETION_SSE_MIDDLE + orjson.dumps(stop_reason or None)
+                                   + COMPLETION_SSE_SUFFIX)
                         if stop_reason:
                             break
                 return Response(generate_stream(), mimetype='text/event-stream')
@@ -553,59 +771,36 @@ def completions():
             response = invoke_with_retry(
                 bedrock_runtime.invoke_model,
                 modelId=model_id, 
-                body=json.dumps(bed_params)
+                body_dict=bed_params
             )
-            bed_response = json.loads(response['body'].read().decode('utf-8'))
+            bed_response = orjson.loads(response['body'].read())
             
-            # 从Bedrock响应中提取内容
-            content = ""
-            thinking_content = ""
+            # 从Bedrock响应中提取主要文本内容和思考内容
+            content, thinking_content = extract_bedrock_content(bed_response)
             
-            # 提取主要文本内容和思考内容
-            if 'content' in bed_response and isinstance(bed_response['content'], list):
-                for item in bed_response['content']:
-                    if item.get('type') == 'text':
-                        content += item.get('text', '')
-            else:
-                # 旧格式响应处理
-                content = bed_response.get('completion', '')
-                if not content:
-                    content_obj = bed_response.get('content', None)
-                    if isinstance(content_obj, list) and len(content_obj) > 0:
-                        content = content_obj[0].get('text', '')
-                    else:
-                        content = str(content_obj) if content_obj else ''
-            
-            # 提取思考内容 (专门针对Claude 3.7)
+            # 思考内容只在Claude 3.7思考模式下返回
             if 'claude-3-7' in model_name and use_thinking_mode:
-                # 在消息对象中查找thinking块
-                thinking_blocks = []
-                
-                # 首先检查顶级thinking字段
-                if 'thinking' in bed_response:
-                    thinking_content = bed_response.get('thinking', {}).get('text', '')
-                
-                # 如果没有找到，尝试在content中查找thinking类型的块
-                if not thinking_content and 'content' in bed_response:
-                    for item in bed_response.get('content', []):
-                        if item.get('type') == 'thinking':
-                            thinking_blocks.append(item.get('thinking', ''))
-                    
-                    if thinking_blocks:
-                        thinking_content = ' '.join(thinking_blocks)
-                
                 if thinking_content:
-                    logger.info(f"成功提取到思考内容，长度: {len(thinking_content)} 字符")
+                    logger.info("成功提取到思考内容，长度: %d 字符", len(thinking_content))
                 else:
                     logger.warning(f"未能提取到思考内容，可能模型没有返回思考块或格式不符")
+            else:
+                thinking_content = ""
             
             stop_reason = bed_response.get('stop_reason', 'stop')
 
-            # 计算token用量
-            prompt_tokens = count_tokens(prompt)
-            completion_tokens = count_tokens(content)
-            thinking_tokens = count_tokens(thinking_content) if thinking_content else 0
-            total_tokens = prompt_tokens + completion_tokens + thinking_tokens
+            # 计算token用量 - 优先使用Bedrock返回的计数，避免在本地重复分词
+            bedrock_usage = get_bedrock_token_usage(response, bed_response)
+            if bedrock_usage:
+                prompt_tokens, completion_tokens = bedrock_usage
+                # Bedrock的输出计数已包含思考内容，思考tokens记为0以免重复计算
+                thinking_tokens = 0
+                total_tokens = prompt_tokens + completion_tokens
+            else:
+                prompt_tokens = count_tokens(prompt)
+                completion_tokens = count_tokens(content)
+                thinking_tokens = count_tokens(thinking_content) if thinking_content else 0
+                total_tokens = prompt_tokens + completion_tokens + thinking_tokens
 
             # 构建OpenAI格式的响应
             openai_response = {
@@ -628,7 +823,7 @@ def completions():
 
             # 记录响应信息
             log_response_info("/v1/completions", openai_response)
-            return jsonify(openai_response)
+            return json_response(openai_response)
 
     except Exception as e:
         error_msg = str(e)
@@ -650,12 +845,13 @@ def list_models():
         # 记录请求信息
         log_request_info("/v1/models", {"method": "GET"})
         
+        created = int(time.time())
         models = []
         for model_name in MODEL_MAPPING.keys():
             models.append({
                 "id": model_name,
                 "object": "model",
-                "created": int(time.time()),
+                "created": created,
                 "owned_by": "anthropic"
             })
         
@@ -666,7 +862,7 @@ def list_models():
         
         # 记录响应信息
         log_response_info("/v1/models", response)
-        return jsonify(response)
+        return json_response(response)
     except Exception as e:
         error_msg = str(e)
         error_response = {'error': error_msg}
@@ -708,7 +904,7 @@ def chat_completions():
             use_thinking_mode = True
         
         # 获取tokens配置
-        max_tokens = req.get('max_tokens', DEFAULT_MAX_TOKENS)
+        max_tokens = to_int(req.get('max_tokens', DEFAULT_MAX_TOKENS), DEFAULT_MAX_TOKENS, 'max_tokens')
         
         # 支持超长输出模式（仅适用于Claude 3.7）
         enable_extended_output = req.get('enable_extended_output', False)
@@ -718,9 +914,12 @@ def chat_completions():
             logger.warning(f"请求的max_tokens({max_tokens})超过了支持的最大值({MAX_OUTPUT_TOKENS})，将使用最大值")
             max_tokens = MAX_OUTPUT_TOKENS
 
-        # 过滤掉内容为空的消息，除了可能的最后一条助手消息
+        # 过滤掉内容为空的消息，除了可能的最后一条助手消息，同时记录是否存在有内容的用户消息
         filtered_messages = []
+        has_user_message = False
+        last_index = len(messages) - 1
         for i, msg in enumerate(messages):
+            role = msg.get('role')
             # 获取消息内容，确保是字符串
             content = msg.get('content', '')
             if isinstance(content, list):
@@ -731,11 +930,13 @@ def chat_completions():
                 has_content = bool(content and content.strip())
             
             # 如果消息有内容，或者是最后一条助手消息，则保留
-            if has_content or (i == len(messages) - 1 and msg.get('role') == 'assistant'):
+            if has_content or (i == last_index and role == 'assistant'):
                 filtered_messages.append(msg)
+                if role == 'user':
+                    has_user_message = True
         
         # 确保至少有一条用户消息
-        if not filtered_messages or not any(msg.get('role') == 'user' for msg in filtered_messages):
+        if not has_user_message:
             return jsonify({'error': 'At least one user message with content is required'}), 400
 
         # 构建基本参数
@@ -755,19 +956,15 @@ def chat_completions():
             # 添加思考参数
             if use_thinking_mode:
                 # 必须添加thinking参数，使用正确的对象格式
-                thinking_budget = None
-                if req.get('max_thinking_tokens', None):
-                    thinking_budget = req.get('max_thinking_tokens')
-                elif req.get('thinking_max_tokens', None):
-                    thinking_budget = req.get('thinking_max_tokens')
-                elif req.get('max_thinking_length', None):
-                    thinking_budget = req.get('max_thinking_length')
-                else:
-                    # 如果未指定，默认使用max_tokens的一半作为思考预算，但不小于4000（推荐值）
-                    thinking_budget = max(4000, int(max_tokens / 2))
+                # 按优先级取第一个指定了的思考预算参数（每个参数只查找一次），
+                # 如果都未指定，默认使用max_tokens的一半作为思考预算，但不小于4000（推荐值）
+                thinking_budget = next(
+                    (value for value in map(req.get, THINKING_BUDGET_KEYS) if value),
+                    max(DEFAULT_THINKING_BUDGET, max_tokens // 2)
+                )
                 
                 # 确保思考预算不小于最低要求的1024 tokens
-                thinking_budget = max(1024, thinking_budget)
+                thinking_budget = max(MIN_THINKING_BUDGET, to_int(thinking_budget, DEFAULT_THINKING_BUDGET, '思考预算'))
                 
                 # 确保思考预算小于max_tokens（AWS要求）
                 if thinking_budget >= max_tokens:
@@ -779,7 +976,7 @@ def chat_completions():
                     "type": "enabled",
                     "budget_tokens": thinking_budget
                 }
-                logger.info(f"已启用Claude 3.7的思考模式，思考预算: {thinking_budget} tokens")
+                logger.info("已启用Claude 3.7的思考模式，思考预算: %s tokens", thinking_budget)
             
             # 支持超长输出模式（beta功能）
             if enable_extended_output and max_tokens > 64000:
@@ -797,117 +994,31 @@ def chat_completions():
             bed_params['stop_sequences'] = req.get('stop') if isinstance(req.get('stop'), list) else [req.get('stop')]
 
         if req.get('stream', False):
-            body = json.dumps(bed_params)
             try:
-                # 记录请求参数，便于调试
-                if 'claude-3-7' in model_name and req.get('thinking', False):
-                    logger.info(f"Claude 3.7思考模式请求参数: {json.dumps(bed_params, indent=2)}")
+                # 调试模式下记录请求参数，避免在正常模式下格式化较大的参数字典
+                if DEBUG_MODE and 'claude-3-7' in model_name and req.get('thinking', False):
+                    logger.info("Claude 3.7思考模式请求参数: %s", orjson.dumps(bed_params, option=orjson.OPT_INDENT_2).decode())
                 
                 # 使用重试机制调用流式API
                 response = invoke_with_retry(
                     bedrock_runtime.invoke_model_with_response_stream,
                     modelId=model_id, 
-                    body=body
+                    body_dict=bed_params
                 )
                 def generate_stream():
+                    # 同一个流中所有chunk的id、created、model都相同，只在流开始时编码一次
+                    now = time.time()
+                    prefix = build_chat_sse_prefix(f"chatcmpl-{int(now * 1000)}", int(now), model_name)
+                    
                     for event in response['body']:
-                        chunk = json.loads(event['chunk']['bytes'].decode('utf-8'))
-                        
-                        # 检查事件类型，处理不同类型的流式事件
-                        event_type = chunk.get('type', '')
-                        
-                        # 处理不同类型的事件
-                        if event_type == 'content_block_delta':
-                            # 处理内容块增量
-                            delta = chunk.get('delta', {})
-                            
-                            # 检查是否是思考块
-                            if delta.get('type') == 'thinking_delta':
-                                # 处理思考内容
-                                thinking_text = delta.get('thinking', '')
-                                if thinking_text:
-                                    thinking_event = {
-                                        "id": f"chatcmpl-{int(time.time() * 1000)}",
-                                        "object": "chat.completion.chunk",
-                                        "created": int(time.time()),
-                                        "model": model_name,
-                                        "choices": [
-                                            {
-                                                "index": 0,
-                                                "delta": {"thinking": thinking_text},
-                                                "finish_reason": None
-                                            }
-                                        ]
-                                    }
-                                    yield f"data: {json.dumps(thinking_event)}\n\n"
-                            
-                            # 检查是否是文本块
-                            elif delta.get('type') == 'text_delta':
-                                # 处理普通文本内容
-                                text = delta.get('text', '')
-                                if text:
-                                    event_data = {
-                                        "id": f"chatcmpl-{int(time.time() * 1000)}",
-                                        "object": "chat.completion.chunk",
-                                        "created": int(time.time()),
-                                        "model": model_name,
-                                        "choices": [
-                                            {
-                                                "index": 0,
-                                                "delta": {"content": text},
-                                                "finish_reason": None
-                                            }
-                                        ]
-                                    }
-                                    yield f"data: {json.dumps(event_data)}\n\n"
-                        
-                        # 处理消息结束
-                        elif event_type == 'message_delta':
-                            stop_reason = chunk.get('delta', {}).get('stop_reason')
-                            if stop_reason:
-                                finish_reason = 'stop' if stop_reason == 'end_turn' else stop_reason
-                                event_data = {
-                                    "id": f"chatcmpl-{int(time.time() * 1000)}",
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model_name,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {},
-                                            "finish_reason": finish_reason
-                                        }
-                                    ]
-                                }
-                                yield f"data: {json.dumps(event_data)}\n\n"
-                                yield f"data: [DONE]\n\n"
+                        chunk = orjson.loads(event['chunk']['bytes'])
                         
-                        # 兼容旧版流式响应格式
-                        elif not event_type:
-                            # 旧的响应格式处理
-                            delta = chunk.get('delta', {})
-                            text = delta.get('text', "")
-                            stop_reason = chunk.get('stop_reason', None)
-                            
-                            if text:
-                                finish_reason = stop_reason if stop_reason else None
-                                event_data = {
-                                    "id": f"chatcmpl-{int(time.time() * 1000)}",
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model_name,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {"content": text},
-                                            "finish_reason": finish_reason
-                                        }
-                                    ]
-                                }
-                                yield f"data: {json.dumps(event_data)}\n\n"
-                            
-                            if stop_reason:
-                                yield f"data: [DONE]\n\n"
+                        # 按事件类型分派处理，不关心的事件类型直接跳过
+                        handler = CHAT_SSE_HANDLERS.get(chunk.get('type') or '')
+                        if handler:
+                            data = handler(chunk, prefix)
+                            if data:
+                                yield data
                 return Response(generate_stream(), mimetype='text/event-stream')
             except AttributeError as e:
                 return jsonify({'error': f'Streaming not supported in this environment: {str(e)}'}), 500
@@ -917,66 +1028,44 @@ def chat_completions():
             response = invoke_with_retry(
                 bedrock_runtime.invoke_model,
                 modelId=model_id, 
-                body=json.dumps(bed_params)
+                body_dict=bed_params
             )
-            bed_response = json.loads(response['body'].read().decode('utf-8'))
+            bed_response = orjson.loads(response['body'].read())
             
-            # 从Bedrock响应中提取内容
-            content = ""
-            thinking_content = ""
+            # 从Bedrock响应中提取主要文本内容和思考内容
+            content, thinking_content = extract_bedrock_content(bed_response)
             
-            # 提取主要文本内容和思考内容
-            if 'content' in bed_response and isinstance(bed_response['content'], list):
-                for item in bed_response['content']:
-                    if item.get('type') == 'text':
-                        content += item.get('text', '')
-            else:
-                # 旧格式响应处理
-                content = bed_response.get('completion', '')
-                if not content:
-                    content_obj = bed_response.get('content', None)
-                    if isinstance(content_obj, list) and len(content_obj) > 0:
-                        content = content_obj[0].get('text', '')
-                    else:
-                        content = str(content_obj) if content_obj else ''
-            
-            # 提取思考内容 (专门针对Claude 3.7)
+            # 思考内容只在Claude 3.7思考模式下返回
             if 'claude-3-7' in model_name and use_thinking_mode:
-                # 在消息对象中查找thinking块
-                thinking_blocks = []
-                
-                # 首先检查顶级thinking字段
-                if 'thinking' in bed_response:
-                    thinking_content = bed_response.get('thinking', {}).get('text', '')
-                
-                # 如果没有找到，尝试在content中查找thinking类型的块
-                if not thinking_content and 'content' in bed_response:
-                    for item in bed_response.get('content', []):
-                        if item.get('type') == 'thinking':
-                            thinking_blocks.append(item.get('thinking', ''))
-                    
-                    if thinking_blocks:
-                        thinking_content = ' '.join(thinking_blocks)
-                
                 if thinking_content:
-                    logger.info(f"成功提取到思考内容，长度: {len(thinking_content)} 字符")
+                    logger.info("成功提取到思考内容，长度: %d 字符", len(thinking_content))
                 else:
                     logger.warning(f"未能提取到思考内容，可能模型没有返回思考块或格式不符")
+            else:
+                thinking_content = ""
             
             stop_reason = bed_response.get('stop_reason', 'stop')
 
-            # 计算token用量
-            prompt_text = " ".join([msg.get('content', '') for msg in messages])
-            prompt_tokens = count_tokens(prompt_text)
-            completion_tokens = count_tokens(content)
-            thinking_tokens = count_tokens(thinking_content) if thinking_content else 0
-            total_tokens = prompt_tokens + completion_tokens + thinking_tokens
+            # 计算token用量 - 优先使用Bedrock返回的计数，避免在本地重复分词
+            bedrock_usage = get_bedrock_token_usage(response, bed_response)
+            if bedrock_usage:
+                prompt_tokens, completion_tokens = bedrock_usage
+                # Bedrock的输出计数已包含思考内容，思考tokens记为0以免重复计算
+                thinking_tokens = 0
+                total_tokens = prompt_tokens + completion_tokens
+            else:
+                # 按消息分别计数并缓存，重复出现的系统提示和历史消息无需重新分词
+                prompt_tokens = sum(count_tokens_cached(get_message_text(msg.get('content', ''))) for msg in messages)
+                completion_tokens = count_tokens(content)
+                thinking_tokens = count_tokens(thinking_content) if thinking_content else 0
+                total_tokens = prompt_tokens + completion_tokens + thinking_tokens
 
             # 构建OpenAI格式的响应
+            now = time.time()
             openai_response = {
-                'id': f"chatcmpl-{int(time.time() * 1000)}",
+                'id': f"chatcmpl-{int(now * 1000)}",
                 'object': "chat.completion",
-                'created': int(time.time()),
+                'created': int(now),
                 'model': model_name,
                 'choices': [
                     {
@@ -1002,7 +1091,7 @@ def chat_completions():
 
             # 记录响应信息
             log_response_info("/v1/chat/completions", openai_response)
-            return jsonify(openai_response)
+            return json_response(openai_response)
 
     except Exception as e:
         error_msg = str(e)
@@ -1045,7 +1134,7 @@ if __name__ == '__main__':
     
     # 基本服务信息
     logger.info(f"可用模型: {', '.join(MODEL_MAPPING.keys())}")
-    logger.info(f"默认模型: {[k for k, v in MODEL_MAPPING.items() if v == DEFAULT_MODEL_ID][0]}")
+    logger.info(f"默认模型: {MODEL_ID_TO_NAME[DEFAULT_MODEL_ID]}")
     logger.info(f"默认输出Tokens: {DEFAULT_MAX_TOKENS}")
     logger.info(f"最大支持输出Tokens: {MAX_OUTPUT_TOKENS}")
     
@@ -1061,5 +1150,5 @@ if __name__ == '__main__':
     logger.info(f"设置: 线程模式={True}, 进程数={1}")
     logger.info("=" * 50)
     
-    # 启动服务器
+    # 启动服务器（开发服务器，生产环境建议使用 gunicorn -k gevent 运行 aws-claude:app）
     app.run(host='0.0.0.0', threaded=True, processes=1)
\ No newline at end of file
@@ -16,9 +16,14 @@ limitations under the License.
 
 import boto3
 
-bedrock = boto3.client('bedrock', region_name='us-east-1')
+def main():
+	"""列出Bedrock上可用的Anthropic模型ID"""
+	bedrock = boto3.client('bedrock', region_name='us-east-1')
 
-response = bedrock.list_foundation_models(byProvider="anthropic")
+	response = bedrock.list_foundation_models(byProvider="anthropic")
 
-for summary in response["modelSummaries"]:
-	print(summary["modelId"])
\ No newline at end of file
+	for summary in response["modelSummaries"]:
+		print(summary["modelId"])
+
+if __name__ == '__main__':
+	main()